@@ -19,10 +19,13 @@
 # along with PytgVoIP.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import multiprocessing
+import ctypes.util
+import functools
+import hashlib
 import os
 import re
 import sys
+import sysconfig
 import platform
 import subprocess
 import shutil
@@ -31,16 +34,214 @@ from setuptools import setup, Extension
 from setuptools.command.build_ext import build_ext
 
 
+# Subtrees that can never contain a libpython archive; pruning them keeps the
+# fallback scan from stat'ing tens of thousands of irrelevant files on
+# manylinux images.
+DEFAULT_SKIP_DIRS = {'tests', 'test', '__pycache__', 'share', 'doc', 'docs', 'man', 'locale'}
+
+
+def _scan_for_file(root, filename):
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return None
+    for entry in entries:
+        if entry.is_file(follow_symlinks=False) and entry.name == filename:
+            return entry.path
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False) and entry.name not in DEFAULT_SKIP_DIRS:
+            found = _scan_for_file(entry.path, filename)
+            if found is not None:
+                return found
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _config_var(name):
+    return sysconfig.get_config_var(name)
+
+
+_LIBPYTHON_RE = re.compile(
+    r'^libpython{}\.{}[a-z]?(m?)\.(so(\.\d+)*|dylib)$'.format(*sys.version_info[:2])
+)
+
+
+def _libpython_from_loaded():
+    # when the interpreter links libpython dynamically the loader already
+    # knows its absolute path; walking the link map costs no file I/O at all
+    if platform.system() != 'Linux':
+        return None
+
+    class _LinkMap(ctypes.Structure):
+        pass
+
+    _LinkMap._fields_ = [
+        ('l_addr', ctypes.c_void_p),
+        ('l_name', ctypes.c_char_p),
+        ('l_ld', ctypes.c_void_p),
+        ('l_next', ctypes.POINTER(_LinkMap)),
+        ('l_prev', ctypes.POINTER(_LinkMap)),
+    ]
+
+    RTLD_DI_LINKMAP = 2
+    try:
+        libc = ctypes.CDLL(None)
+        dlinfo = libc.dlinfo
+    except (OSError, AttributeError):
+        return None
+    dlinfo.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    link_map = ctypes.POINTER(_LinkMap)()
+    if dlinfo(libc._handle, RTLD_DI_LINKMAP, ctypes.byref(link_map)) != 0:
+        return None
+    node = link_map
+    # dlinfo returns the node for the queried handle, not necessarily the
+    # head of the chain; rewind so every loaded object is inspected
+    while node and node.contents.l_prev:
+        node = node.contents.l_prev
+    while node:
+        name = node.contents.l_name
+        if name:
+            path = name.decode()
+            if _LIBPYTHON_RE.match(os.path.basename(path)) and os.path.isfile(path):
+                return path
+        node = node.contents.l_next
+    return None
+
+
+def _find_existing_libpython():
+    loaded = _libpython_from_loaded()
+    if loaded:
+        return loaded
+    libdir = _config_var('LIBDIR')
+    if not libdir:
+        return None
+    try:
+        entries = os.scandir(libdir)
+    except OSError:
+        return None
+    for entry in entries:
+        if _LIBPYTHON_RE.match(entry.name) and entry.is_file():
+            return entry.path
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _find_static_libpython_fallback():
+    ver = '{}.{}'.format(*sys.version_info[:2])
+    filename = 'libpython{}.a'.format(ver)
+    # sysconfig usually knows exactly where the archive lives; only fall
+    # back to scanning /opt when it doesn't.
+    library = _config_var('LIBRARY')
+    for dirvar in ('LIBPL', 'LIBDIR'):
+        dirname = _config_var(dirvar)
+        if not dirname:
+            continue
+        for name in filter(None, (library, filename)):
+            candidate = os.path.join(dirname, name)
+            if candidate.endswith('.a') and os.path.isfile(candidate):
+                return candidate
+    for root in ('/opt/_internal', '/opt/python'):
+        if os.path.isdir(root):
+            found = _scan_for_file(root, filename)
+            if found is not None:
+                return found
+    return None
+
+
+def _build_shared_libpython_from_static(static_path, out_dir):
+    ver = '{}.{}'.format(*sys.version_info[:2])
+    out = os.path.join(out_dir, 'libpython{}.so'.format(ver))
+    if os.path.isfile(out) and os.path.getmtime(out) >= os.path.getmtime(static_path):
+        return out
+    os.makedirs(out_dir, exist_ok=True)
+    cc = os.environ.get('CC', 'gcc')
+    # -O0/-pipe: this shim only re-exports already-compiled objects, so
+    # codegen quality is irrelevant and link time is all that matters.
+    # --no-undefined is deliberately not passed; the archive references
+    # symbols (dl, util, pthread) resolved at load time.
+    args = [cc, '-shared', '-fPIC', '-O0', '-pipe', '-o', out,
+            '-Wl,--whole-archive', static_path, '-Wl,--no-whole-archive',
+            '-lm', '-ldl', '-lutil', '-lpthread']
+    linker = os.environ.get('PYTGVOIP_LINKER')
+    if linker is None:
+        for candidate in ('mold', 'lld'):
+            if shutil.which(candidate) or shutil.which('ld.' + candidate):
+                linker = candidate
+                break
+    if linker:
+        # both mold and lld parallelize by themselves; --threads=N is not
+        # passed since the =N form is rejected by lld < 10
+        args += ['-fuse-ld=' + linker]
+    try:
+        subprocess.check_call(args)
+    except (subprocess.CalledProcessError, OSError):
+        # manylinux archives are typically built without -fPIC, so the
+        # shared link can fail with relocation errors; the hint is optional
+        # (the extension only needs Development.Module), so just skip it
+        return None
+    return out
+
+
+def _fast_copy(src, dst_dir):
+    # copyfile uses the zero-copy fast path (sendfile/copy_file_range) and
+    # skips shutil.copy's permission-bit juggling; the temp-name + os.replace
+    # makes the file appear atomically even if the build is interrupted
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    tmp = dst + '.tmp'
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return dst
+
+
+def _run(args, cwd=None, env=None):
+    # stream subprocess output through as it is produced instead of letting
+    # it sit in a pipe buffer; keeps cmake's progress visible in real time
+    process = subprocess.Popen(args, cwd=cwd, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True)
+    with process:
+        for line in process.stdout:
+            sys.stdout.write(line)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+@functools.lru_cache(maxsize=1)
+def _march_native_supported():
+    cc = os.environ.get('CC', 'cc')
+    if shutil.which(cc) is None:
+        return False
+    try:
+        result = subprocess.run([cc, '-march=native', '-E', '-x', 'c', '-'],
+                                input=b'', capture_output=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return result.returncode == 0
+
+
+def _n_jobs():
+    for var in ('CMAKE_BUILD_PARALLEL_LEVEL', 'NPY_NUM_BUILD_JOBS'):
+        value = os.environ.get(var)
+        if value and value.isdigit():
+            return int(value)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=1)
 def check_libraries():
-    args = 'gcc -lssl -lopus'.split()
-    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-        stdout, stderr = process.communicate()
-        match = re.findall(r'cannot find -l(\w+)', stderr.decode())
-        if match:
-            raise RuntimeError(
-                'Following libraries are not installed: {}\nFor installation guide refer to '
-                'https://pytgvoip.readthedocs.io/en/latest/guides/install.html'.format(', '.join(match))
-            )
+    if os.environ.get('PYTGVOIP_SKIP_LIB_CHECK'):
+        return
+    if ctypes.util.find_library('c') is None:
+        # the probe itself cannot resolve anything on this system
+        # (no ldconfig/gcc); let the real build surface missing libraries
+        return
+    missing = [lib for lib in ('ssl', 'opus') if ctypes.util.find_library(lib) is None]
+    if missing:
+        raise RuntimeError(
+            'Following libraries are not installed: {}\nFor installation guide refer to '
+            'https://pytgvoip.readthedocs.io/en/latest/guides/install.html'.format(', '.join(missing))
+        )
 
 
 class CMakeExtension(Extension):
@@ -51,25 +252,29 @@ class CMakeExtension(Extension):
 
 class CMakeBuild(build_ext):
     def run(self):
-        try:
-            out = subprocess.check_output(['cmake', '--version'])
-        except OSError:
+        # egg_info/sdist/clean don't need the native build; don't pay for
+        # the cmake probe and library checks when pip runs them.
+        if any(cmd in sys.argv[:2] for cmd in ('egg_info', 'sdist', 'clean')):
+            return
+
+        for ext in self.extensions:
+            self.build_extension(ext)
+
+    def build_extension(self, ext):
+        if shutil.which('cmake') is None:
             raise RuntimeError("CMake must be installed to build the following extensions: " +
                                ", ".join(e.name for e in self.extensions))
 
         if platform.system() != 'Windows':
             check_libraries()
 
-        for ext in self.extensions:
-            self.build_extension(ext)
-
-    def build_extension(self, ext):
         extdir = os.path.abspath(os.path.dirname(self.get_ext_fullpath(ext.name)))
         cmake_args = ['-DCMAKE_LIBRARY_OUTPUT_DIRECTORY=' + extdir,
                       '-DPYTHON_EXECUTABLE=' + sys.executable]
 
         cfg = 'Release'
         build_args = ['--config', cfg, '--target', '_tgvoip']
+        libpython = None
 
         if platform.system() == "Windows":
             cmake_args += ['-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_{}={}'.format(cfg.upper(), extdir)]
@@ -77,33 +282,110 @@ class CMakeBuild(build_ext):
                 cmake_args += ['-A', 'x64']
             else:
                 cmake_args += ['-A', 'Win32']
-            build_args += ['--', '/m:{}'.format(multiprocessing.cpu_count() + 1)]
         else:
             cmake_args += ['-DCMAKE_BUILD_TYPE=' + cfg]
-            build_args += ['--', '-j{}'.format(multiprocessing.cpu_count() + 1)]
+            if shutil.which('ninja') and 'CMAKE_GENERATOR' not in os.environ:
+                cmake_args += ['-G', 'Ninja']
+            libpython = _find_existing_libpython()
+            ldlibrary = _config_var('LDLIBRARY') or ''
+            interpreter_has_shared = bool(_config_var('Py_ENABLE_SHARED')) or \
+                ldlibrary.endswith(('.so', '.dylib'))
+            if not libpython and not interpreter_has_shared:
+                # only synthesize a shim when the interpreter truly has no
+                # shared libpython of its own
+                static = _find_static_libpython_fallback()
+                if static:
+                    libpython = _build_shared_libpython_from_static(static, self.build_temp)
+            if libpython:
+                cmake_args += ['-DPython3_LIBRARY=' + libpython]
+
+        if not os.environ.get('PYTGVOIP_NO_LTO') and \
+                (shutil.which('ld.gold') or shutil.which('ld.lld')):
+            cmake_args += ['-DCMAKE_INTERPROCEDURAL_OPTIMIZATION=ON']
+        # the vendored webrtc_dsp tree is not unity-safe (aec_core.cc and
+        # aec_core_sse2.cc both define static MulRe/MulIm helpers, which
+        # collide when batched into one TU), so unity stays opt-in
+        if os.environ.get('PYTGVOIP_UNITY') and not os.environ.get('PYTGVOIP_NO_UNITY'):
+            cmake_args += ['-DCMAKE_UNITY_BUILD=ON']
+
+        if not os.environ.get('PYTGVOIP_NO_CCACHE') and \
+                'CMAKE_CXX_COMPILER_LAUNCHER' not in os.environ:
+            launcher = shutil.which('ccache') or shutil.which('sccache')
+            if launcher:
+                cmake_args += ['-DCMAKE_C_COMPILER_LAUNCHER=' + launcher,
+                               '-DCMAKE_CXX_COMPILER_LAUNCHER=' + launcher]
+
+        jobs = _n_jobs()
+        explicit_jobs = any(
+            (os.environ.get(var) or '').isdigit()
+            for var in ('CMAKE_BUILD_PARALLEL_LEVEL', 'NPY_NUM_BUILD_JOBS')
+        )
+        if jobs <= 2 and not explicit_jobs:
+            jobs += 1
+        build_args += ['--parallel', str(jobs)]
 
         env = os.environ.copy()
+        env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(jobs)
         env['CXXFLAGS'] = '{} -DVERSION_INFO=\\"{}\\"'.format(env.get('CXXFLAGS', ''),
                                                               self.distribution.get_version())
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
-        subprocess.check_call(['cmake', ext.sourcedir] + cmake_args, cwd=self.build_temp, env=env)
-        subprocess.check_call(['cmake', '--build', '.'] + build_args, cwd=self.build_temp)
-        shutil.copy(os.path.join('src', '_tgvoip.pyi'), extdir)
+        # develop builds (no BUILD env, same machine runs the result) may
+        # target the local CPU; wheel builds (BUILD or cibuildwheel) must
+        # stay generic. Restricted to architectures whose compilers are
+        # known to accept -march=native (older Apple clang on arm64 and gcc
+        # on riscv64/ppc64 reject it outright).
+        if platform.system() != 'Windows' and os.environ.get('BUILD') is None \
+                and os.environ.get('CIBUILDWHEEL') is None \
+                and not os.environ.get('PYTGVOIP_NO_NATIVE') \
+                and platform.machine() in ('x86_64', 'aarch64', 'arm64') \
+                and _march_native_supported():
+            env['CXXFLAGS'] += ' -march=native'
+            env['CFLAGS'] = '{} -march=native'.format(env.get('CFLAGS', ''))
+        os.makedirs(self.build_temp, exist_ok=True)
+
+        # reconfiguring is expensive (compiler checks, try_compiles); skip it
+        # when the cache exists and was produced by these exact arguments.
+        # CXXFLAGS/CFLAGS are part of the payload because configure bakes
+        # them into the cache (-DVERSION_INFO, -march=native).
+        config_stamp = hashlib.sha256(
+            '\0'.join([ext.sourcedir, env['CXXFLAGS'], env.get('CFLAGS', '')] + cmake_args).encode()
+        ).hexdigest()
+        stamp_path = os.path.join(self.build_temp, '.cmake_args_stamp')
+        cache_path = os.path.join(self.build_temp, 'CMakeCache.txt')
+        stamp_matches = False
+        if os.path.isfile(cache_path) and os.path.isfile(stamp_path):
+            with open(stamp_path) as f:
+                stamp_matches = f.read() == config_stamp
+        if not stamp_matches:
+            _run(['cmake', '-S', ext.sourcedir, '-B', self.build_temp] + cmake_args, env=env)
+            with open(stamp_path, 'w') as f:
+                f.write(config_stamp)
+        _run(['cmake', '--build', self.build_temp] + build_args, env=env)
+        _fast_copy(os.path.join('src', '_tgvoip.pyi'), extdir)
+        if libpython and libpython.startswith(self.build_temp):
+            # a synthesized shim must travel with the extension
+            _fast_copy(libpython, extdir)
 
 
 def get_version():
     init_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'src', 'tgvoip', '__init__.py')
+    version_re = re.compile(r"__version__ = '(.+)'")
     with open(init_path, encoding='utf-8') as f:
-        version = re.findall(r"__version__ = '(.+)'", f.read())[0]
-        if os.environ.get('BUILD') is None and 'pip' not in __file__:
-            version += '+develop'
-        return version
+        for line in f:
+            match = version_re.match(line)
+            if match:
+                version = match.group(1)
+                break
+        else:
+            raise RuntimeError('__version__ not found in {}'.format(init_path))
+    if os.environ.get('BUILD') is None and 'pip' not in __file__:
+        version += '+develop'
+    return version
 
 
 def get_long_description():
-    with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'README.md'), encoding='utf-8') as f:
-        return f.read()
+    readme_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'README.md')
+    with open(readme_path, 'rb') as f:
+        return f.read().decode('utf-8')
 
 
 setup(